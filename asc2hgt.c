@@ -1,8 +1,9 @@
+#define _GNU_SOURCE
+
 #include <stdlib.h>
 #include <string.h>
 #include <stdio.h>
-#include <assert.h>
-#include <sys/stat.h>
+#include <fcntl.h>
 
 typedef struct tag_Metadata {
   int iCols;
@@ -32,38 +33,39 @@ int main(int argc, const char *argv[])
   }
 
   Metadata md;
+  long lValue;
 
-  char TempBuffer[80];
+  memset(&md, 0, sizeof(md));
 
   for (int i = 0; i < 6; i++)
   {
-
-    fgets(ReadBuffer, sizeof(ReadBuffer), InFile);
+  //Header lines are "<keyword> <value>". The padding after the keyword
+  //differs between exporters, so skip the keyword instead of assuming
+  //the value starts at a fixed column.
+    if ((fgets(ReadBuffer, sizeof(ReadBuffer), InFile) == NULL) || (sscanf(ReadBuffer, "%*s %ld", &lValue) != 1))
+    {
+      fprintf(stderr, "Error: Invalid header in %s\n", argv[1]);
+      return 1;
+    }
 
     switch(i) {
       case 0:
-        strcpy(TempBuffer, &ReadBuffer[6]);
-        md.iCols = atoi(TempBuffer);
+        md.iCols = lValue;
         break;
       case 1:
-        strcpy(TempBuffer, &ReadBuffer[6]);
-        md.iRows = atoi(TempBuffer);
+        md.iRows = lValue;
         break;
       case 2:
-        strcpy(TempBuffer, &ReadBuffer[10]);
-        md.lXLLCenter = atoi(TempBuffer);
+        md.lXLLCenter = lValue;
         break;
       case 3:
-        strcpy(TempBuffer, &ReadBuffer[10]);
-        md.lYLLCenter = atoi(TempBuffer);
+        md.lYLLCenter = lValue;
         break;
       case 4:
-        strcpy(TempBuffer, &ReadBuffer[9]);
-        md.iCellSize = atoi(TempBuffer);
+        md.iCellSize = lValue;
         break;
       case 5:
-        strcpy(TempBuffer, &ReadBuffer[13]);
-        md.iNoDataValue = atoi(TempBuffer);
+        md.iNoDataValue = lValue;
         break;
       default:
         break;
@@ -89,53 +91,60 @@ int main(int argc, const char *argv[])
     return 1;
   }
 
+//Reserve the blocks for the whole grid up front so the file system can lay
+//the output out in one piece. KEEP_SIZE leaves the visible file size alone,
+//and a file system without fallocate support simply allocates as we write.
+  if ((md.iCols > 0) && (md.iRows > 0))
+  {
+    fallocate(fileno(OutFile), FALLOC_FL_KEEP_SIZE, 0, (off_t) md.iCols * md.iRows * sizeof(short int));
+  }
+
   short int iCurrentElevation;
+  short int RowBuffer[sizeof(ReadBuffer) / 2];
   int iCurrentLine = 0;
   int iCurrentCol = 0;
   
   fprintf(stderr, "Info: writing file %s...\n", szTmpFilename);
 
-  while (!feof(InFile))
+  while (fgets(ReadBuffer, sizeof(ReadBuffer), InFile) != NULL)
   {
-    memset(ReadBuffer, 0, sizeof(ReadBuffer));
-    fgets(ReadBuffer, sizeof(ReadBuffer), InFile);
     iCurrentLine++;
 
-  //Establish string and get the first token  
-    char *token = strtok(ReadBuffer, " ");
-    if (token != NULL)
+  //The row is parsed in a single walk: the end pointer of strtol (or of
+  //strtod for fractional and exponent values) marks where each number ends,
+  //so there is no separate tokenizing pass over the line. Line breaks count
+  //as blanks, so zero elevations are kept like any other value.
+    char *pCurrent = ReadBuffer;
+    char *pEnd;
+    for (;;)
     {
-      iCurrentCol = 1;
-      iCurrentElevation = (int) atof(token);
-      fwrite(&iCurrentElevation, sizeof(short int), 1, OutFile);
-      if (iCurrentCol == 5761)
-        fprintf(stderr, "%4d %4d: %d\n", iCurrentLine, iCurrentCol, iCurrentElevation);
-    }
-
-  //Find next token  
-    while (token != NULL) {
-      if (*token != '\n')
-      {
-        iCurrentElevation = (int) atof(token = strtok(NULL, " "));
-        if (iCurrentElevation != 0)
-        {
-          iCurrentCol++;
-          fwrite(&iCurrentElevation, sizeof(short int), 1, OutFile);
-          if (iCurrentCol == 5761)
-          {
-            fprintf(stderr, "%4d %4d: %d\n", iCurrentLine, iCurrentCol, iCurrentElevation);
-            //getchar();
-          }
-        }
-      }
-      else
+      pCurrent += strspn(pCurrent, " \t\r\n");
+      if (*pCurrent == '\0') break;
+
+    //Plain integers take the strtol fast path. Values with a fraction or
+    //an exponent (e.g. "255.7", "3.05e-05") are re-parsed with strtod and
+    //truncated toward zero, exactly like the old (int) atof()
+      iCurrentElevation = (short int) strtol(pCurrent, &pEnd, 10);
+      if ((*pEnd == '.') || (*pEnd == 'e') || (*pEnd == 'E'))
       {
-        token = NULL;
+        iCurrentElevation = (short int) strtod(pCurrent, &pEnd);
       }
+      RowBuffer[iCurrentCol++] = iCurrentElevation;
+
+    //pEnd is past the complete number, including any fraction or exponent.
+    //Only a non-numeric token (stored as 0, as atof did) leaves characters
+    //before the next blank, and those are skipped here.
+      pCurrent = pEnd + strcspn(pEnd, " \t\r\n");
     }
-    iCurrentCol = 1;
+
+  //The whole row goes out with a single write
+    if (iCurrentCol > 0)
+    {
+      fwrite(RowBuffer, sizeof(short int), iCurrentCol, OutFile);
+    }
+    iCurrentCol = 0;
   }
-                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                            
+
   fflush(OutFile);
 
   fclose(InFile);
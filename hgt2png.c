@@ -1,8 +1,11 @@
+#define _GNU_SOURCE
+
 #include <stddef.h>
 #include <stdlib.h>
 #include <string.h>
 #include <stdio.h>
 
+#include <endian.h>
 #include <sys/types.h>
 #include <sys/stat.h>
 #include <unistd.h>
@@ -14,6 +17,7 @@
 #define _MAX_PATH    255
 #define _MAX_FILES   255
 #define _MAX_HEIGHT 6000
+#define _READ_CHUNK 32768
 
 typedef int errno_t;
 
@@ -42,16 +46,21 @@ typedef struct tag_FileInfoHGT {
   short int iHeight;
   short int iMinElevation;
   short int iMaxElevation;
+  int iHGTType;
   unsigned long ulFilesize;
 } FileInfo, *pFileInfo;
 
 FileInfo *fi;
-RGB *PixelData;
+unsigned char *PixelData;
 RGB *ZoningData;
+unsigned char GreyTable[_MAX_HEIGHT + 1];
+RGB ZoningTable[_MAX_HEIGHT + 1];
+short int ReadChunk[_READ_CHUNK];
 
 void WritePNG(const char *, short int, short int);
 void WriteZoningPNG(const char *, short int, short int);
 void CreateZoning(Zoning *, int);
+static inline void ConvertElevationData(const short int *, unsigned char *, RGB *, unsigned long, const int, const int);
 
 const int HGT_TYPE_30 = 1201;
 const int HGT_TYPE_90 = 3601;
@@ -59,8 +68,6 @@ const int HGT_TYPE_UNKNOWN = -1;
 const int HGT_TYPE_30_SIZE = 1201 * 1201 * sizeof(short int);
 const int HGT_TYPE_90_SIZE = 3601 * 3601 * sizeof(short int);
 
-int iHGTType;
-
 char OutputHeightmapFile[_MAX_PATH];
 char OutputZoningFile[_MAX_PATH];
 
@@ -82,38 +89,69 @@ int main(int argc, const char *argv[])
   int iNumIntRead;
   int iNumFilesToConvert = 0;
   int iNumberOfZonings = 3;
+  int bWriteZoning = 0;
+  int iArg = 1;
+  unsigned long ulMaxFilesize = 0;
 
   Zoning *z;
 
   fprintf(stderr, "\nhgt2png Converter v1.0 (C) 2016\n");
 
-  if (argc == 1)  
+  if ((argc > 1) && (strcmp(argv[1], "-z") == 0))
+  {
+    bWriteZoning = 1;
+    iArg = 2;
+  }
+
+  if (argc <= iArg)  
   {
-    fprintf(stderr, "\nusage: hgt2png <filename>|<filelist>\n\n");
+    fprintf(stderr, "\nusage: hgt2png [-z] <filename>|<filelist>\n\n");
+    fprintf(stderr, "  -z  also write the elevation zoning map (*_ZON.PNG)\n\n");
     return 1;
   }
 
-  if ((strstr(argv[1], "HGT") != NULL) || strstr(argv[1], "hgt") != NULL)
+  if (strcasestr(argv[iArg], "hgt") != NULL)
   {
     fprintf(stderr, "INFO: Single-File Mode\n");
-    sCurrentFilename[0] = (char *) malloc(strlen(argv[1]));
-    strcpy(sCurrentFilename[0], argv[1]);
+    sCurrentFilename[0] = (char *) malloc(strlen(argv[iArg]) + 1);
+    strcpy(sCurrentFilename[0], argv[iArg]);
     iNumFilesToConvert = 1;
   }
   else
   {  
     fprintf(stderr, "INFO: Filelist Mode\n");
-    if ((FileList = fopen(argv[1], "rb")) == NULL) {
-      fprintf(stderr, "Error: Can't open file list %s\n", argv[1]);
+    if ((FileList = fopen(argv[iArg], "rb")) == NULL) {
+      fprintf(stderr, "Error: Can't open file list %s\n", argv[iArg]);
       return 1;
     }
 
-    while (!feof(FileList))
+    while (fgets(sBuffer, sizeof(sBuffer), FileList) != NULL)
     {
-      fgets(sBuffer,sizeof(sBuffer), FileList);
-      sCurrentFilename[f] = (char *) malloc(strlen(sBuffer));
+      sBuffer[strcspn(sBuffer, "\r\n")] = '\0';
+      if (sBuffer[0] == '\0') continue;
+
+    //A tile listed twice would only be converted twice to the same output
+      int bDuplicate = 0;
+      for (int d = 0; d < f; d++)
+      {
+        if (strcmp(sCurrentFilename[d], sBuffer) == 0) bDuplicate = 1;
+      }
+      if (bDuplicate)
+      {
+        fprintf(stderr, "INFO: Skipping duplicate entry %s\n", sBuffer);
+        continue;
+      }
+
+    //Refuse oversized lists instead of silently converting only a part
+      if (f == _MAX_FILES)
+      {
+        fprintf(stderr, "Error: File list %s has more than %d entries\n", argv[iArg], _MAX_FILES);
+        fclose(FileList);
+        return 1;
+      }
+
+      sCurrentFilename[f] = (char *) malloc(strlen(sBuffer) + 1);
       strcpy(sCurrentFilename[f], sBuffer);
-      sCurrentFilename[f][strlen(sCurrentFilename[f]) - 1] = '\0';
       f++;	
     }
 
@@ -129,14 +167,6 @@ int main(int argc, const char *argv[])
     return 1;
   }
 
-  if ((z = (Zoning *) malloc(iNumberOfZonings * sizeof(struct tag_Zoning))) == NULL)
-  {
-    fprintf(stderr, "Error: Can't allocate Zoning array\n");
-    return 1;
-  }
-
-  CreateZoning(z, iNumberOfZonings);
-
   struct stat buf;
 
   iOverallMinElevation = 9999;
@@ -163,18 +193,24 @@ int main(int argc, const char *argv[])
 
     fstat(fileno(InFile), &buf);
     fi[i].ulFilesize = buf.st_size;
+    if (fi[i].ulFilesize > ulMaxFilesize) ulMaxFilesize = fi[i].ulFilesize;
 
     if (fi[i].ulFilesize == HGT_TYPE_30_SIZE)
     {
-      iHGTType = HGT_TYPE_30;
+      fi[i].iHGTType = HGT_TYPE_30;
       fi[i].iWidth = 1201;
       fi[i].iHeight = 1201;
     } else if (fi[i].ulFilesize == HGT_TYPE_90_SIZE)
     {
-      iHGTType = HGT_TYPE_90;
+      fi[i].iHGTType = HGT_TYPE_90;
       fi[i].iWidth = 3601;
       fi[i].iHeight = 3601;
     }
+    else if (strlen(sCurrentFilename[i]) < 14)
+    {
+    //Too short to carry the dimensions, don't guess from bytes past the name
+      fi[i].iHGTType = HGT_TYPE_UNKNOWN;
+    }
     else
     {
       memcpy(sTmp, &sCurrentFilename[i][5], 4);
@@ -183,163 +219,208 @@ int main(int argc, const char *argv[])
       memcpy(sTmp, &sCurrentFilename[i][10], 4);
       sTmp[4] = '\0';
       fi[i].iHeight = atoi(sTmp);
-      iHGTType = fi[i].iWidth * fi[i].iHeight;
+      if ((fi[i].iWidth > 0) && (fi[i].iHeight > 0) && ((unsigned long) fi[i].iWidth * fi[i].iHeight * sizeof(short int) == fi[i].ulFilesize))
+      {
+        fi[i].iHGTType = fi[i].iWidth * fi[i].iHeight;
+      }
+      else
+      {
+        fi[i].iHGTType = HGT_TYPE_UNKNOWN;
+      }
       free(sCurrentFilename[i]);
     }
 
-    if (iHGTType == HGT_TYPE_UNKNOWN) {
+    if (fi[i].iHGTType == HGT_TYPE_UNKNOWN) {
       fprintf(stderr, "Error: %s has an unknown HGT type\n", fi[i].szFilename);
       fclose(InFile);
       return 1;
     }
 
-    if ((iElevationData = (short *) malloc(fi[i].ulFilesize)) == NULL)
+  //Only Min/Max are needed here, so the file is streamed through a small
+  //fixed buffer that stays in cache instead of being loaded as a whole
+    short int iMinElevation = 9999;
+    short int iMaxElevation = 0;
+    unsigned long ulSamples = fi[i].ulFilesize / 2;
+    int bSwapBytes = (fi[i].iHGTType == HGT_TYPE_30 || fi[i].iHGTType == HGT_TYPE_90);
+    for (unsigned long ulOffset = 0; ulOffset < ulSamples; ulOffset += iNumIntRead)
     {
-      fprintf(stderr, "Error: Can't allocate memory to load %s\n", fi[i].szFilename);
-      fclose(InFile);
-      return 1;
-    }
+      size_t iChunk = (ulSamples - ulOffset < _READ_CHUNK) ? ulSamples - ulOffset : _READ_CHUNK;
 
-    if ((iNumIntRead = fread(iElevationData, 1, fi[i].ulFilesize, InFile)) != fi[i].ulFilesize)
-    {
-      fprintf(stderr, "Error: Can't load elevation data\n");
-      fclose(InFile);
-      return 1;
-    } 
+      if ((iNumIntRead = fread(ReadChunk, sizeof(short int), iChunk, InFile)) != iChunk)
+      {
+        fprintf(stderr, "Error: Can't load elevation data\n");
+        fclose(InFile);
+        return 1;
+      }
 
-    iCurrentMaxElevation = 0;
-    iCurrentMinElevation = 9999;
-    for (unsigned long j = 0; j < fi[i].ulFilesize / 2; j++)
-    {
-      if (iHGTType == HGT_TYPE_30 || iHGTType == HGT_TYPE_90)
+      for (int j = 0; j < iNumIntRead; j++)
       {
-        iElevationData[j] = (short)(((iElevationData[j] & 0xff) << 8) | ((iElevationData[j] & 0xff00) >> 8));
+        short int iElevation = ReadChunk[j];
+        if (bSwapBytes)
+        {
+          iElevation = (short) be16toh((unsigned short) iElevation);
+        }
+        if (iElevation < 0) iElevation = 0;
+        if (iElevation > _MAX_HEIGHT) iElevation = _MAX_HEIGHT; //TO-DO
+        if (iElevation < iMinElevation) iMinElevation = iElevation;
+        if (iElevation > iMaxElevation) iMaxElevation = iElevation;
       }
-      if (iElevationData[j] < 0) iElevationData[j] = 0;
-      if (iElevationData[j] > _MAX_HEIGHT) iElevationData[j] = _MAX_HEIGHT; //TO-DO
-      if (iElevationData[j] < iCurrentMinElevation) iCurrentMinElevation = iElevationData[j];
-      if (iElevationData[j] > iCurrentMaxElevation) iCurrentMaxElevation = iElevationData[j];
     }
+    iCurrentMinElevation = fi[i].iMinElevation = iMinElevation;
+    iCurrentMaxElevation = fi[i].iMaxElevation = iMaxElevation;
 
     if (iCurrentMinElevation < iOverallMinElevation) iOverallMinElevation = iCurrentMinElevation;
     if (iCurrentMaxElevation > iOverallMaxElevation) iOverallMaxElevation = iCurrentMaxElevation;
     fprintf(stderr, "- MIN=%4d MAX=%4d\n", iOverallMinElevation, iOverallMaxElevation);
     
-    free(iElevationData);
     fclose(InFile);
   }
 
-  for (int k = 0; k < iNumFilesToConvert; k++)
+  //Elevation -> grey value lookup table, replaces the per-pixel division
+  for (int e = 0; e <= _MAX_HEIGHT; e++)
   {
-    if ((InFile = fopen(fi[k].szFilename, "rb")) == NULL) {
-      fprintf(stderr, "Error: Can't open input file %s\n", fi[k].szFilename);
-      return 1;
-    }
+    GreyTable[e] = (iOverallMaxElevation != 0) ? e * 255 / iOverallMaxElevation : 0;
+  }
 
-    if ((iElevationData = (short *) malloc(fi[k].ulFilesize)) == NULL)
+  //Elevation -> zoning color lookup table, replaces the gradient scan per pixel.
+  //The gradients are only needed to fill it, and only when -z was given.
+  if (bWriteZoning)
+  {
+    if ((z = (Zoning *) malloc(iNumberOfZonings * sizeof(struct tag_Zoning))) == NULL)
     {
-      fprintf(stderr, "Error: Can't allocate elevation data block %s\n", fi[k].szFilename);
-      fclose(InFile);
+      fprintf(stderr, "Error: Can't allocate Zoning array\n");
       return 1;
     }
 
-    if ((iNumIntRead = fread(iElevationData, 1, fi[k].ulFilesize, InFile)) != fi[k].ulFilesize)
-    {
-      fprintf(stderr, "Filename: %s\n", fi[k].szFilename);
-      fprintf(stderr, "Filesize: %d\n", (unsigned int) fi[k].ulFilesize);
-      fprintf(stderr, "Error: Can't load elevation data 2\n");
-      fclose(InFile);
-      return 1;
-    } 
-
-    fclose(InFile);
+    CreateZoning(z, iNumberOfZonings);
 
-    if ((ZoningData = (RGB *) malloc(fi[k].ulFilesize * sizeof(struct tag_RGB))) == NULL)
+    for (int e = 0; e <= _MAX_HEIGHT; e++)
     {
-      fprintf(stderr, "Error: Can't allocate zoning data block.\n");
-      return 1;
+      ZoningTable[e].r = ZoningTable[e].g = ZoningTable[e].b = GreyTable[e];
+
+      for (int g = 0; g < z->iNumberOfGradients; g++)
+      {
+        if ((e >= z[g].gradient.iMinElevation) && (e <= z[g].gradient.iMaxElevation))
+        {
+          ZoningTable[e] = z[g].gradient.StartColor;
+          break;
+        }
+      }
     }
 
-    if ((PixelData = (RGB *) malloc(fi[k].ulFilesize * sizeof(struct tag_RGB))) == NULL)
+    free(z);
+  }
+
+  //The conversion buffers are sized for the largest file of the batch and
+  //reused for every file instead of being allocated and freed per file
+  if ((iElevationData = (short *) malloc(ulMaxFilesize)) == NULL)
+  {
+    fprintf(stderr, "Error: Can't allocate elevation data block.\n");
+    return 1;
+  }
+
+  if (bWriteZoning && (ZoningData = (RGB *) malloc(ulMaxFilesize / 2 * sizeof(struct tag_RGB))) == NULL)
+  {
+    fprintf(stderr, "Error: Can't allocate zoning data block.\n");
+    return 1;
+  }
+
+  if ((PixelData = (unsigned char *) malloc(ulMaxFilesize / 2)) == NULL)
+  {
+    fprintf(stderr, "Error: Can't allocate pixel data block.\n");
+    return 1;
+  }
+
+  for (int k = 0; k < iNumFilesToConvert; k++)
+  {
+  //Loop invariants are held in locals: the byte stores into the pixel
+  //buffers may alias any global, which would force a reload per pixel
+    unsigned long ulSamples = fi[k].ulFilesize / 2;
+    int bSwapBytes = (fi[k].iHGTType == HGT_TYPE_30 || fi[k].iHGTType == HGT_TYPE_90);
+    unsigned char *pPixel = PixelData;
+    RGB *pZoning = ZoningData;
+
+  //Flat tile (e.g. all sea level): the pre-pass already knows the only
+  //elevation, so fill the output without reading the file a second time
+    if (fi[k].iMinElevation == fi[k].iMaxElevation)
     {
-      fprintf(stderr, "Error: Can't allocate pixel data block.\n");
-      return 1;
+      memset(pPixel, GreyTable[fi[k].iMinElevation], ulSamples);
+
+      if (bWriteZoning)
+      {
+        for (unsigned long m = 0; m < ulSamples; m++)
+        {
+          pZoning[m] = ZoningTable[fi[k].iMinElevation];
+        }
+      }
     }
-     
-    for (int m = 0; m < (fi[k].ulFilesize) / 2; m++)
+    else
     {
-      if (iHGTType == HGT_TYPE_30 || iHGTType == HGT_TYPE_90)
-      {
-        iElevationData[m] = (short)(((iElevationData[m] & 0xff) << 8) | ((iElevationData[m] & 0xff00) >> 8));
+      if ((InFile = fopen(fi[k].szFilename, "rb")) == NULL) {
+        fprintf(stderr, "Error: Can't open input file %s\n", fi[k].szFilename);
+        return 1;
       }
 
-      if (iOverallMaxElevation != 0)
+      if ((iNumIntRead = fread(iElevationData, 1, fi[k].ulFilesize, InFile)) != fi[k].ulFilesize)
       {
-        PixelData[m].r = PixelData[m].g = PixelData[m].b = iElevationData[m] * 255 / iOverallMaxElevation;
-      }
-       
-      //Zoning
-     
-      ZoningData[m].r = PixelData[m].r;
-      ZoningData[m].g = PixelData[m].g;
-      ZoningData[m].b = PixelData[m].b;
-     
-      for (int g = 0; g < z->iNumberOfGradients; g++)
+        fprintf(stderr, "Filename: %s\n", fi[k].szFilename);
+        fprintf(stderr, "Filesize: %d\n", (unsigned int) fi[k].ulFilesize);
+        fprintf(stderr, "Error: Can't load elevation data 2\n");
+        fclose(InFile);
+        return 1;
+      } 
+
+      fclose(InFile);
+
+    //One specialized copy of the conversion loop per swap/zoning combination
+      #pragma omp parallel
       {
-        if ((iElevationData[m] >= z[g].gradient.iMinElevation) && (iElevationData[m] <= z[g].gradient.iMaxElevation))
+        if (bSwapBytes)
         {
-          switch (g)
-          {
-            case 0:
-              ZoningData[m].r = z[0].gradient.StartColor.r;
-              ZoningData[m].g = z[0].gradient.StartColor.g;
-              ZoningData[m].b = z[0].gradient.StartColor.b;
-              break;
-            case 1:
-              ZoningData[m].r = z[1].gradient.StartColor.r;
-              ZoningData[m].g = z[1].gradient.StartColor.g;
-              ZoningData[m].b = z[1].gradient.StartColor.b;
-              break;
-            case 2:
-              ZoningData[m].r = z[2].gradient.StartColor.r;
-              ZoningData[m].g = z[2].gradient.StartColor.g;
-              ZoningData[m].b = z[2].gradient.StartColor.b;
-              break;
-            default:
-              break;
-          }
+          if (bWriteZoning)
+            ConvertElevationData(iElevationData, pPixel, pZoning, ulSamples, 1, 1);
+          else
+            ConvertElevationData(iElevationData, pPixel, pZoning, ulSamples, 1, 0);
+        }
+        else
+        {
+          if (bWriteZoning)
+            ConvertElevationData(iElevationData, pPixel, pZoning, ulSamples, 0, 1);
+          else
+            ConvertElevationData(iElevationData, pPixel, pZoning, ulSamples, 0, 0);
         }
       }
     }
 
     strcpy(OutputHeightmapFile, fi[k].szFilename);
     OutputHeightmapFile[strlen(OutputHeightmapFile) - 4] = '\0';
+    strcpy(OutputZoningFile, OutputHeightmapFile);
     strcat(OutputHeightmapFile, "_HGT.PNG");
     
     WritePNG(OutputHeightmapFile, fi[k].iWidth, fi[k].iHeight);
 
-    strcpy(OutputZoningFile, fi[k].szFilename);
-    OutputZoningFile[strlen(OutputZoningFile) - 4] = '\0';
-    strcat(OutputZoningFile, "_ZON.PNG");
-      
-//  WriteZoningPNG(OutputZoningFile, fi[k].iWidth, fi[k].iHeight);
-
-  //Free allocated memory  
-    if (iElevationData != NULL)
+    if (bWriteZoning)
     {
-      free(iElevationData);
+      strcat(OutputZoningFile, "_ZON.PNG");
+      
+      WriteZoningPNG(OutputZoningFile, fi[k].iWidth, fi[k].iHeight);
     }
+  }
 
-    if (ZoningData != NULL)
-    {
-      free(ZoningData);
-    }
+//Free allocated memory  
+  if (iElevationData != NULL)
+  {
+    free(iElevationData);
+  }
 
-    if (PixelData != NULL)
-    {
-      free(PixelData);
-    }
+  if (ZoningData != NULL)
+  {
+    free(ZoningData);
+  }
 
+  if (PixelData != NULL)
+  {
+    free(PixelData);
   }
 
   free(fi);
@@ -356,7 +437,7 @@ void WritePNG(const char *szFilename, short int _iWidth, short int _iHeight)
   memset(&image, 0, sizeof image);
 
   image.version = PNG_IMAGE_VERSION;
-  image.format = PNG_FORMAT_RGB;
+  image.format = PNG_FORMAT_GRAY;
   image.width = _iWidth;
   image.height = _iHeight;
 
@@ -400,6 +481,33 @@ void WriteZoningPNG(const char *szFilename, short int _iWidth, short int _iHeigh
 
 }
 
+//Always inlined and only called with constant flags, so the compiler
+//emits a branch-free loop for each combination instead of testing the
+//flags for every sample. The loop is shared out among the threads of the
+//caller's parallel region.
+static inline __attribute__((always_inline)) void ConvertElevationData(const short int *_iElevationData, unsigned char *_pPixel, RGB *_pZoning, unsigned long _ulSamples, const int _bSwapBytes, const int _bWriteZoning)
+{
+  #pragma omp for
+  for (unsigned long m = 0; m < _ulSamples; m++)
+  {
+    short int iElevation = _iElevationData[m];
+    if (_bSwapBytes)
+    {
+      iElevation = (short) be16toh((unsigned short) iElevation);
+    }
+    if (iElevation < 0) iElevation = 0;
+    if (iElevation > _MAX_HEIGHT) iElevation = _MAX_HEIGHT;
+
+    _pPixel[m] = GreyTable[iElevation];
+
+    //Zoning
+    if (_bWriteZoning)
+    {
+      _pZoning[m] = ZoningTable[iElevation];
+    }
+  }
+}
+
 void CreateZoning(Zoning *z, int _iNumberOfZonings)
 {
   z[0].iNumberOfGradients = _iNumberOfZonings;